@@ -1,4 +1,3 @@
-import requests
 from abc import ABC, abstractmethod
 from typing import Dict
 
@@ -13,6 +12,9 @@ class HttpBettor(Bettor):
     def __init__(self, api_key, dry_run=False):
         self._api_key = api_key
         self._dry_run = dry_run
+        # Imported here so that runs that don't bet start quickly.
+        import requests
+        self._session = requests.Session()
 
     def bet(self, market_id: str, bet: str) -> None:
         if bet == "DO_NOTHING":
@@ -24,7 +26,7 @@ class HttpBettor(Bettor):
         else:
             raise ValueError(f"Invalid bet: {bet}")
 
-        response = requests.post(
+        response = self._session.post(
             "https://api.manifold.markets/v0/bet",
             headers={
                 'Authorization': f'Key {self._api_key}',
@@ -1,11 +1,15 @@
 import datetime
 import json
+import os
 import textwrap
+import threading
 
-from typing import List, Dict
+from concurrent.futures import Future
+from typing import List, Dict, Optional
 
 from decision_maker import DecisionMaker
 from llm import Llm
+from market_clusters import MarketClusterIndex
 from market_fetcher import MarketFetcher
 from search_handler import SearchHandler
 
@@ -15,11 +19,46 @@ def _comments_to_string_list(comments):
 
 
 class Bot:
-    def __init__(self, decision_maker: DecisionMaker, market_fetcher: MarketFetcher, search_handler: SearchHandler, search_llm: Llm):
+    def __init__(self, decision_maker: DecisionMaker, market_fetcher: MarketFetcher, search_handler: SearchHandler, search_llm: Llm,
+                 market_clusters: Optional[MarketClusterIndex] = None, cluster_file: Optional[str] = None):
         self._decision_maker = decision_maker
         self._market_fetcher = market_fetcher
         self._search_handler = search_handler
         self._search_llm = search_llm
+        # If set, near-duplicate markets share a single search query and its results.
+        self._market_clusters = market_clusters
+        # The first market of a cluster to be processed does the search, and any
+        # others processed concurrently wait on its future.
+        self._cluster_search_results: Dict[str, Future] = {}
+        # Guards the cluster index and search results when markets are processed concurrently.
+        self._cluster_lock = threading.Lock()
+        # If set, cluster assignments and their search results are saved here,
+        # so a resumed run keeps the clusters of the markets it already did.
+        self._cluster_file = cluster_file
+        if market_clusters and cluster_file and os.path.exists(cluster_file):
+            self._load_clusters(cluster_file)
+
+    def _load_clusters(self, cluster_file: str):
+        with open(cluster_file, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self._market_clusters.add(record['market_url'], record['text'], record['cluster_id'])
+                if record.get('search_results') is not None and record['cluster_id'] not in self._cluster_search_results:
+                    future = Future()
+                    future.set_result(record['search_results'])
+                    self._cluster_search_results[record['cluster_id']] = future
+
+    def _save_cluster(self, market_url: str, market_data: Dict, search_results: Dict[str, List[str]]):
+        record = {
+            "market_url": market_url,
+            "cluster_id": market_data['cluster_id'],
+            "text": self._get_cluster_text(market_data),
+            "search_results": search_results if self._search_handler else None,
+        }
+        with self._cluster_lock, open(self._cluster_file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
 
     # Note: this function is currently only used for generating search queries.
     def _get_market_string(self, market_data: Dict):
@@ -51,7 +90,8 @@ Write only the search query, nothing else.
         # Only return a single search query.
         return [self._search_llm.sample_text(prompt, max_tokens=32).strip()]
 
-    def _generate_final_decision_prompt(self, market_data: Dict, search_results: Dict[str, List[str]]) -> str:
+    def _generate_final_decision_prompt(self, market_data: Dict, search_results: Dict[str, List[str]],
+                                        template: Optional[str] = None) -> str:
         question = market_data['title']
         description = market_data['description']
         today = market_data['current_date'].strftime("%Y-%m-%d")
@@ -63,6 +103,18 @@ Write only the search query, nothing else.
             formatted_search_results = "\n".join(
                 [f"- {snippet}" for snippets in search_results.values() for snippet in snippets])
 
+        if template is not None:
+            # A custom prompt, e.g. from a multi-strategy run. It's a format
+            # string that can use any of these fields.
+            return template.format(
+                question=question,
+                description=description,
+                today=today,
+                close_date=market_data['close_date'].strftime("%Y-%m-%d"),
+                comments=comments,
+                search_results=formatted_search_results,
+            )
+
         prompt = f"""
 You are an advanced AI system which has been finetuned to provide calibrated probabilistic forecasts under uncertainty, with your performance evaluated according to the Brier score. When forecasting, do not treat 0.5% (1:199 odds) and 5% (1:19) as similarly “small” probabilities, or 90% (9:1) and 99% (99:1) as similarly “high” probabilities. As the odds show, they are markedly different, so output your probabilities accordingly. You will forecast the resolution of a question on the prediction market site Manifold Markets.
 
@@ -125,6 +177,27 @@ You are an advanced AI system which has been finetuned to provide calibrated pro
     def _get_search_results_for_market(self, market_data: Dict) -> Dict[str, List[str]]:
         if not self._search_handler:
             return {}
+        cluster_id = market_data.get('cluster_id')
+        if cluster_id is None:
+            return self._search_for_market(market_data)
+        with self._cluster_lock:
+            future = self._cluster_search_results.get(cluster_id)
+            is_searcher = future is None
+            if is_searcher:
+                future = Future()
+                self._cluster_search_results[cluster_id] = future
+        if is_searcher:
+            try:
+                future.set_result(self._search_for_market(market_data))
+            except BaseException as e:
+                # Let the next market in the cluster try again.
+                with self._cluster_lock:
+                    del self._cluster_search_results[cluster_id]
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def _search_for_market(self, market_data: Dict) -> Dict[str, List[str]]:
         search_prompt = self._generate_search_query_prompt(market_data)
         search_queries = self._get_llm_search_queries(search_prompt)
         return {query: self._search_handler.search(query) for query in search_queries}
@@ -132,6 +205,8 @@ You are an advanced AI system which has been finetuned to provide calibrated pro
     def _format_search_results(self, search_results: Dict[str, List[str]]):
         # For now, we should only be making one search query.
         assert len(search_results) <= 1
+        if not search_results:
+            return None, ""
         query, results = list(search_results.items())[0]
         results = "\n\n".join(results)
         return query, results
@@ -139,18 +214,52 @@ You are an advanced AI system which has been finetuned to provide calibrated pro
     def get_market_data(self, market_url: str) -> Dict:
         return self._market_fetcher.get_market_data(market_url)
 
-    def get_decision_for_market(self, market_url: str):
+    def _get_cluster_text(self, market_data: Dict) -> str:
+        return f"{market_data['title']}\n{market_data['description'] or ''}"
+
+    def get_market_context(self, market_url: str) -> Dict:
+        """Gathers everything needed to make a decision, without making it."""
         market_data = self.get_market_data(market_url)
+        is_new_to_clusters = False
+        if self._market_clusters:
+            with self._cluster_lock:
+                is_new_to_clusters = self._market_clusters.get_cluster(market_url) is None
+                market_data['cluster_id'] = self._market_clusters.add(
+                    market_url, self._get_cluster_text(market_data))
         search_results = self._get_search_results_for_market(market_data)
+        if is_new_to_clusters and self._cluster_file:
+            self._save_cluster(market_url, market_data, search_results)
+        return {
+            "market_url": market_url,
+            "market_data": market_data,
+            "search_results": search_results,
+        }
+
+    def get_decision_from_context(self, context: Dict, decision_maker: Optional[DecisionMaker] = None,
+                                  prompt_template: Optional[str] = None) -> Dict:
+        """
+        Makes a decision from the output of get_market_context. The same
+        context can be reused by several decision makers and prompts.
+        """
+        decision_maker = decision_maker or self._decision_maker
+        market_data = context['market_data']
+        search_results = context['search_results']
         final_prompt = self._generate_final_decision_prompt(
-            market_data, search_results)
+            market_data, search_results, prompt_template)
         market_probability = market_data['probability']
-        decision = self._decision_maker.make_decision(
+        decision = decision_maker.make_decision(
             final_prompt, market_probability)
-        decision["market_url"] = market_url
+        decision["market_url"] = context['market_url']
         decision["market_probability"] = market_probability
         decision["prompt"] = final_prompt
+        if 'cluster_id' in market_data:
+            decision["cluster_id"] = market_data['cluster_id']
         decision["search_query"], decision["search_results"] = (
             self._format_search_results(search_results)
         )
-        return decision, market_data
+        return decision
+
+    def get_decision_for_market(self, market_url: str):
+        context = self.get_market_context(market_url)
+        decision = self.get_decision_from_context(context)
+        return decision, context['market_data']
@@ -0,0 +1,99 @@
+import json
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from bot import Bot
+
+
+class DecisionService:
+    """
+    Makes decisions for single markets with a long-lived Bot, so its clients,
+    HTTP sessions and caches stay warm between requests.
+
+    Concurrent requests for the same market are coalesced: they all wait on
+    the same in-flight decision instead of each making their own.
+    """
+
+    def __init__(self, bot: Bot, output_file: Optional[str] = None, max_workers: int = 4):
+        self._bot = bot
+        self._output_file = output_file
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._output_lock = threading.Lock()
+
+    def _make_decision(self, market_url: str) -> Dict:
+        try:
+            decision, _ = self._bot.get_decision_for_market(market_url)
+            if self._output_file:
+                with self._output_lock, open(self._output_file, 'a') as outfile:
+                    outfile.write(json.dumps(decision) + "\n")
+            print(f"Market: {market_url}, Decision: {decision['decision']}")
+            return decision
+        finally:
+            with self._lock:
+                del self._in_flight[market_url]
+
+    def get_decision(self, market_url: str) -> Dict:
+        with self._lock:
+            future = self._in_flight.get(market_url)
+            if future is None:
+                future = self._executor.submit(self._make_decision, market_url)
+                self._in_flight[market_url] = future
+        return future.result()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Set by serve().
+    service: DecisionService = None
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/decision":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            market_url = json.loads(self.rfile.read(length))["market_url"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Expected a JSON body with a market_url: {e}"})
+            return
+        try:
+            decision = self.service.get_decision(market_url)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, decision)
+
+
+def serve(service: DecisionService, host: str = "127.0.0.1", port: int = 8539):
+    """
+    Serves decisions until interrupted. Request a decision with e.g.
+
+    curl -X POST localhost:8539/decision -d '{"market_url": "https://manifold.markets/..."}'
+    """
+    handler = type("RequestHandler", (_RequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving decisions on http://{host}:{port}/decision")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -2,7 +2,8 @@ from abc import ABC, abstractmethod
 import json
 import random
 import re
-from typing import Dict
+import threading
+from typing import Collection, Dict, Optional
 from llm import Llm
 
 
@@ -23,48 +24,114 @@ class RandomDecisionMaker(DecisionMaker):
         return result
 
 
+def _parse_probability(response_text: str):
+    """Returns (probability, error_str) for the number in the <answer></answer> tags."""
+    # This error should be populated if there is any error.
+    error_str = None
+
+    # Extract the probability from the <answer></answer> tags
+    regex = r'<answer>\s*\**\s*(.*?)\s*\**\s*</answer>'
+    answer_match = re.search(regex, response_text, re.DOTALL)
+    if answer_match:
+        probability_str = answer_match.group(1).strip()
+        try:
+            probability = float(probability_str)
+        except ValueError as e:
+            probability = None
+            error_str = str(e)
+    else:
+        probability = None
+        error_str = f"Could not find a match for regex: {regex}"
+
+    if probability is not None and not (0 <= probability <= 1):
+        error_str = f"Probability {probability} is not in the range [0, 1]"
+        probability = None
+
+    return probability, error_str
+
+
+def _decide(probability, market_probability: float) -> str:
+    # Decide the action based on the comparison
+    if probability is None:
+        return "DO_NOTHING"
+    elif probability < market_probability:
+        return "BUY_NO"
+    elif probability > market_probability:
+        return "BUY_YES"
+    else:
+        return "DO_NOTHING"
+
+
+def _generate_triage_prompt(prompt: str) -> str:
+    return f"""
+Below is a forecasting task, delimited by <task></task> tags. Do NOT follow its step-by-step instructions. Instead, give a quick gut-check forecast.
+
+<task>
+{prompt}
+</task>
+
+Respond with only your probability (a number between 0 and 1) in <answer></answer> tags, followed by your confidence in that estimate (low, medium, or high) in <confidence></confidence> tags. Write nothing else.
+"""
+
+
 class LlmDecisionMaker(DecisionMaker):
-    def __init__(self, llm: Llm):
+    """
+    Asks an LLM for a probability and bets in the direction of its disagreement
+    with the market.
+
+    If triage_llm is set, runs in cascade mode: a cheap, short-output forecast
+    comes first, and the full forecast from llm only runs if the quick
+    estimate is within escalation_margin of the market probability or its
+    confidence is not in confident_levels. Otherwise the quick estimate is used
+    directly, since the direction of the bet is already clear.
+    """
+
+    def __init__(
+            self,
+            llm: Llm,
+            triage_llm: Optional[Llm] = None,
+            escalation_margin: float = 0.15,
+            confident_levels: Collection[str] = ("high",),
+    ):
         self.llm = llm
+        self.triage_llm = triage_llm
+        self.escalation_margin = escalation_margin
+        self.confident_levels = confident_levels
+        self.stats = {
+            "triaged": 0,
+            "escalated": 0,
+            # Escalated markets where both forecasts produced a probability,
+            # and how often they would have made the same bet.
+            "compared": 0,
+            "agreed": 0,
+            "total_abs_difference": 0.0,
+        }
+        # Markets may be decided concurrently, e.g. in daemon mode.
+        self._stats_lock = threading.Lock()
 
-    def make_decision(self, prompt: str, market_probability: float) -> Dict:
-        # Send the prompt to the LLM
-        response_text = self.llm.sample_text(prompt)
+    def _triage(self, prompt: str):
+        response_text = self.triage_llm.sample_text(
+            _generate_triage_prompt(prompt), max_tokens=64)
+        probability, _ = _parse_probability(response_text)
+        confidence_match = re.search(
+            r'<confidence>\s*(.*?)\s*</confidence>', response_text, re.DOTALL)
+        confidence = confidence_match.group(1).strip().lower() if confidence_match else None
+        return probability, confidence, response_text
 
-        # This error should be populated if there is any error.
-        # If this happens we will just print a warning and use DO_NOTHING.
-        error_str = None
-
-        # Extract the probability from the <answer></answer> tags
-        regex = r'<answer>\s*\**\s*(.*?)\s*\**\s*</answer>'
-        answer_match = re.search(regex, response_text, re.DOTALL)
-        if answer_match:
-            probability_str = answer_match.group(1).strip()
-            try:
-                probability = float(probability_str)
-            except ValueError as e:
-                probability = None
-                error_str = str(e)
-        else:
-            probability = None
-            error_str = f"Could not find a match for regex: {regex}"
+    def _should_escalate(self, probability, confidence, market_probability: float) -> bool:
+        if probability is None or confidence not in self.confident_levels:
+            return True
+        return abs(probability - market_probability) < self.escalation_margin
 
-        if probability is not None and not (0 <= probability <= 1):
-            error_str = f"Probability {probability} is not in the range [0, 1]"
-            probability = None
+    def _make_full_decision(self, prompt: str, market_probability: float) -> Dict:
+        # Send the prompt to the LLM
+        response_text = self.llm.sample_text(prompt)
 
-        # Decide the action based on the comparison
-        if probability is None:
-            decision = "DO_NOTHING"
-        elif probability < market_probability:
-            decision = "BUY_NO"
-        elif probability > market_probability:
-            decision = "BUY_YES"
-        else:
-            decision = "DO_NOTHING"
+        # If there is an error we will just print a warning and use DO_NOTHING.
+        probability, error_str = _parse_probability(response_text)
 
         result = {
-            "decision": decision,
+            "decision": _decide(probability, market_probability),
             "reasoning": response_text
         }
         if probability is not None:
@@ -73,3 +140,50 @@ class LlmDecisionMaker(DecisionMaker):
             result["error"] = error_str
             print(f"WARNING: in LlmDecisionMaker, got the error: {error_str}")
         return result
+
+    def make_decision(self, prompt: str, market_probability: float) -> Dict:
+        if not self.triage_llm:
+            return self._make_full_decision(prompt, market_probability)
+
+        triage_probability, confidence, triage_text = self._triage(prompt)
+        with self._stats_lock:
+            self.stats["triaged"] += 1
+        triage_decision = _decide(triage_probability, market_probability)
+
+        escalated = self._should_escalate(triage_probability, confidence, market_probability)
+        if not escalated:
+            result = {
+                "decision": triage_decision,
+                "reasoning": triage_text,
+                "probability": triage_probability,
+            }
+        else:
+            result = self._make_full_decision(prompt, market_probability)
+            with self._stats_lock:
+                self.stats["escalated"] += 1
+                if triage_probability is not None and "probability" in result:
+                    self.stats["compared"] += 1
+                    self.stats["agreed"] += int(triage_decision == result["decision"])
+                    self.stats["total_abs_difference"] += abs(
+                        triage_probability - result["probability"])
+
+        result["triage_probability"] = triage_probability
+        result["triage_confidence"] = confidence
+        result["escalated"] = escalated
+        return result
+
+    def get_stats_summary(self) -> str:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        triaged = stats["triaged"]
+        escalated = stats["escalated"]
+        if not triaged:
+            return "No markets were triaged."
+        summary = f"Escalated {escalated}/{triaged} markets ({escalated / triaged:.0%}) to the full forecast."
+        compared = stats["compared"]
+        if compared:
+            summary += (
+                f" The quick forecast agreed with the full forecast on {stats['agreed']}/{compared} bets,"
+                f" with a mean absolute difference of {stats['total_abs_difference'] / compared:.3f}."
+            )
+        return summary
@@ -1,9 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import Dict, Any
 
-import anthropic
 import json
-import os
 
 
 class Llm(ABC):
@@ -18,16 +16,19 @@ class Llm(ABC):
         pass
 
 class MockLlm(Llm):
-    def sample_text(self, prompt: str) -> str:
+    def sample_text(self, prompt: str, max_tokens=4096) -> str:
         return f"MOCK LLM<{prompt}>MOCK LLM"
 
 class ClaudeLlm(Llm):
     def __init__(self, api_key, model):
-        os.environ['ANTHROPIC_API_KEY'] = api_key
+        # Imported here so that runs that don't use Claude start quickly.
+        import anthropic
+        # Reuse one client so its HTTP connections stay open between calls.
+        self._client = anthropic.Anthropic(api_key=api_key)
         self.model = model
 
     def sample_text(self, prompt: str, max_tokens=4096) -> str:
-        response = anthropic.Anthropic().messages.create(
+        response = self._client.messages.create(
             model=self.model,
             max_tokens=max_tokens,
             messages=[
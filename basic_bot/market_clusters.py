@@ -0,0 +1,101 @@
+import random
+import re
+import zlib
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+# A Mersenne prime larger than any CRC32 value, for the MinHash permutations.
+_PRIME = (1 << 61) - 1
+
+
+def _shingles(text: str, size: int) -> set:
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MarketClusterIndex:
+    """
+    Groups near-duplicate markets using MinHash with locality-sensitive hashing.
+
+    Markets are added one at a time. Each market joins the cluster of the most
+    similar previously added market whose estimated Jaccard similarity (over
+    word shingles of the title and description) is at least threshold, with
+    ties going to the market added first. If there is none, it starts a new
+    cluster of its own.
+    """
+
+    def __init__(self, num_bands: int = 16, rows_per_band: int = 4, shingle_size: int = 3,
+                 threshold: float = 0.5, seed: int = 0):
+        self._num_bands = num_bands
+        self._rows_per_band = rows_per_band
+        self._shingle_size = shingle_size
+        self._threshold = threshold
+        # Use our own seeded hash functions rather than hash(), which is
+        # randomized between Python processes.
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(num_bands * rows_per_band)
+        ]
+        self._buckets = [defaultdict(list) for _ in range(num_bands)]
+        self._signatures: Dict[str, Sequence[int]] = {}
+        self._clusters: Dict[str, str] = {}
+        self._order: Dict[str, int] = {}
+
+    def _signature(self, text: str) -> List[int]:
+        hashes = [zlib.crc32(s.encode()) for s in _shingles(text, self._shingle_size)]
+        if not hashes:
+            return []
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in self._permutations]
+
+    def _similarity(self, sig1: Sequence[int], sig2: Sequence[int]) -> float:
+        return sum(x == y for x, y in zip(sig1, sig2)) / len(self._permutations)
+
+    def _bands(self, signature: Sequence[int]):
+        r = self._rows_per_band
+        for band in range(self._num_bands):
+            yield band, tuple(signature[band * r:(band + 1) * r])
+
+    def add(self, key: str, text: str, cluster_id: Optional[str] = None) -> str:
+        """
+        Adds a market and returns its cluster ID (the key of the cluster's first
+        market). If cluster_id is given, the market joins that cluster, e.g.
+        when restoring the clusters of an earlier run.
+        """
+        if key in self._clusters:
+            return self._clusters[key]
+        signature = self._signature(text)
+        assigned = cluster_id is not None
+        if not assigned:
+            cluster_id = key
+        if signature:
+            candidates = []
+            for band, band_hash in self._bands(signature):
+                candidates.extend(self._buckets[band][band_hash])
+            # Join the cluster of the most similar candidate, breaking ties in
+            # favor of whichever was added first.
+            best_similarity = None
+            for candidate in [] if assigned else sorted(set(candidates), key=self._order.__getitem__):
+                similarity = self._similarity(signature, self._signatures[candidate])
+                if similarity >= self._threshold and (best_similarity is None or similarity > best_similarity):
+                    best_similarity = similarity
+                    cluster_id = self._clusters[candidate]
+            for band, band_hash in self._bands(signature):
+                self._buckets[band][band_hash].append(key)
+            self._signatures[key] = signature
+        self._order[key] = len(self._order)
+        self._clusters[key] = cluster_id
+        return cluster_id
+
+    def get_cluster(self, key: str) -> Optional[str]:
+        return self._clusters.get(key)
+
+    def get_clusters(self) -> Dict[str, List[str]]:
+        """Returns a map from each cluster ID to the keys of its members."""
+        clusters = defaultdict(list)
+        for key, cluster_id in self._clusters.items():
+            clusters[cluster_id].append(key)
+        return dict(clusters)
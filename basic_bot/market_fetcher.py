@@ -1,9 +1,9 @@
 import datetime
+import json
 import random
-import requests
 
 from abc import ABC, abstractmethod
-from typing import Dict
+from typing import Dict, Optional
 
 def datetime_from_millis(millis: int):
     return datetime.datetime.fromtimestamp(millis / 1000)
@@ -38,8 +38,7 @@ MOCK_MARKET_DATA = [
         "id": "1",
         "creator": "Bob",
         "probability": 0.7,
-        "current_date": NOW_MILLISECONDS,
-        "close_date": NOW_MILLISECONDS,
+        "closeTime": NOW_MILLISECONDS,
         "comments": [
             {"user": "Alice", "text": "I think this is unlikely given current progress.",
                     "time": NOW_MILLISECONDS},
@@ -48,17 +47,16 @@ MOCK_MARKET_DATA = [
         ]
     },
     {
-        "title": "Will SpaceX successfully land humans on Mars by 2028?",
+        "question": "Will SpaceX successfully land humans on Mars by 2028?",
         "textDescription": "This market resolves to YES if SpaceX lands at least one human safely on the surface of Mars before January 1, 2029.",
         "id": "2",
         "creator": "Charlie",
         "probability": 0.3,
-        "current_date": NOW_MILLISECONDS,
-        "close_date": NOW_MILLISECONDS,
+        "closeTime": NOW_MILLISECONDS,
         "comments": [
-            {"userName": "Alice", "text": "There are still many technological hurdles to overcome.",
+            {"user": "Alice", "text": "There are still many technological hurdles to overcome.",
              "time": NOW_MILLISECONDS},
-            {"userName": "Bob", "text": "SpaceX has been making rapid progress",
+            {"user": "Bob", "text": "SpaceX has been making rapid progress",
              "time": NOW_MILLISECONDS},
         ]
     }
@@ -72,6 +70,17 @@ class MockMarketFetcher(MarketFetcher):
 
 
 class HttpMarketFetcher(MarketFetcher):
+    def __init__(self):
+        self._session = None
+
+    def _get_session(self):
+        # Imported lazily so that runs with --mock_markets start quickly. The
+        # session keeps connections to Manifold open between requests.
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
     def _collect_comment_text(self, data, collected_texts):
         if isinstance(data, dict):
             for key, value in data.items():
@@ -84,7 +93,7 @@ class HttpMarketFetcher(MarketFetcher):
                 self._collect_comment_text(item, collected_texts)
 
     def _get_comments_data(self, slug: str):
-        comments_response = requests.get(
+        comments_response = self._get_session().get(
             f"https://api.manifold.markets/v0/comments",
             params={"contractSlug": slug, "limit": 1000}
         )
@@ -104,13 +113,68 @@ class HttpMarketFetcher(MarketFetcher):
             result.append(comment_data)
         return result
 
+    def _get_market_json(self, slug: str) -> Dict:
+        market_response = self._get_session().get(
+            f"https://api.manifold.markets/v0/slug/{slug}")
+        market_response.raise_for_status()
+        return market_response.json()
+
     def get_market_data(self, market_url: str) -> Dict:
         slug = market_url.split('/')[-1]
 
-        market_response = requests.get(
-            f"https://api.manifold.markets/v0/slug/{slug}")
-        market_response.raise_for_status()
-        market_data = market_response.json()
+        market_data = self._get_market_json(slug)
+
+        market_data["comments"] = self._get_comments_data(slug)
+
+        return self._result_from_data(market_data)
+
+
+class PrefetchedMarketFetcher(HttpMarketFetcher):
+    """
+    Reads market metadata from the file written by select_markets.py (a JSON
+    object keyed by market URL), so that only the comments and the current
+    probability need to be fetched for each market. The file is only trusted
+    for fields that don't change, since the probability may have moved since
+    it was written.
+
+    Markets that are missing from the file or are missing fields (e.g. the
+    description, which select_markets.py leaves out with --ignore_tags) are
+    fetched in full.
+    """
+    _STATIC_FIELDS = ("id", "question", "textDescription", "closeTime", "creatorName")
+    _REQUIRED_FIELDS = ("id", "question", "textDescription", "closeTime")
+
+    def __init__(self, metadata_file: str):
+        super().__init__()
+        with open(metadata_file, 'r') as f:
+            self._metadata = json.load(f)
+        num_without_description = sum("textDescription" not in metadata for metadata in self._metadata.values())
+        if num_without_description:
+            print(f"WARNING: {num_without_description}/{len(self._metadata)} markets in {metadata_file}"
+                  " have no description (e.g. because select_markets.py was run with --ignore_tags),"
+                  " so they will be fetched in full.")
+
+    def _get_probability(self, market_id: str) -> Optional[float]:
+        response = self._get_session().get(f"https://api.manifold.markets/v0/market/{market_id}/prob")
+        response.raise_for_status()
+        # Only binary markets have a single probability.
+        return response.json().get("prob")
+
+    def get_market_data(self, market_url: str) -> Dict:
+        slug = market_url.split('/')[-1]
+
+        metadata = self._metadata.get(market_url)
+        market_data = None
+        if metadata is not None and all(field in metadata for field in self._REQUIRED_FIELDS):
+            probability = self._get_probability(metadata["id"])
+            if probability is not None:
+                market_data = {field: metadata[field] for field in self._STATIC_FIELDS if field in metadata}
+                market_data["probability"] = probability
+        if market_data is None:
+            market_data = self._get_market_json(slug)
+            # Remember the static fields, in case we need the market again.
+            self._metadata[market_url] = {
+                field: market_data[field] for field in self._STATIC_FIELDS if field in market_data}
 
         market_data["comments"] = self._get_comments_data(slug)
 
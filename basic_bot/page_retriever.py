@@ -0,0 +1,262 @@
+import codecs
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+class _TextExtractor(HTMLParser):
+    _SKIPPED_TAGS = {"script", "style", "noscript", "head", "svg", "nav", "footer", "template"}
+    _BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+                   "section", "article", "blockquote", "pre", "table", "ul", "ol"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip_depth = 0
+        self._parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in self._BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self._BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._parts.append(data)
+
+    def get_text(self) -> str:
+        lines = (re.sub(r'\s+', ' ', line).strip() for line in "".join(self._parts).split("\n"))
+        return "\n".join(line for line in lines if line)
+
+
+def extract_text(html: str) -> str:
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.get_text()
+
+
+def split_passages(text: str, passage_words: int = 120, stride: int = 100) -> List[str]:
+    """Splits text into overlapping windows of passage_words words."""
+    words = text.split()
+    passages = []
+    for start in range(0, len(words), stride):
+        passages.append(" ".join(words[start:start + passage_words]))
+        if start + passage_words >= len(words):
+            break
+    return passages
+
+
+class PassageIndex:
+    """A BM25 inverted index over page passages, persisted in a SQLite file."""
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The connection may be used from several threads (e.g. in daemon
+        # mode), as long as only one uses it at a time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._k1 = k1
+        self._b = b
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                fetched_at REAL NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS passages (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                text TEXT NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS passages_url ON passages (url);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                passage_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+        """)
+
+    def get_fetch_status(self, url: str) -> Optional[Tuple[float, bool]]:
+        """Returns when url was last fetched and whether that fetch failed, or None if it never was."""
+        row = self._connection.execute(
+            "SELECT fetched_at, failed FROM pages WHERE url = ?", (url,)).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def add_page(self, url: str, passages: Sequence[str], failed: bool = False):
+        """Replaces the passages for url. If failed is True, records that the page couldn't be fetched."""
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM postings WHERE passage_id IN (SELECT id FROM passages WHERE url = ?)", (url,))
+            self._connection.execute("DELETE FROM passages WHERE url = ?", (url,))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages (url, fetched_at, failed) VALUES (?, ?, ?)",
+                (url, time.time(), int(failed)))
+            for passage in passages:
+                terms = Counter(_tokenize(passage))
+                cursor = self._connection.execute(
+                    "INSERT INTO passages (url, text, length) VALUES (?, ?, ?)",
+                    (url, passage, sum(terms.values())))
+                self._connection.executemany(
+                    "INSERT INTO postings (term, passage_id, tf) VALUES (?, ?, ?)",
+                    [(term, cursor.lastrowid, tf) for term, tf in terms.items()])
+
+    def search(self, query: str, urls: Sequence[str], limit: int) -> List[Tuple[str, str]]:
+        """Returns up to limit (url, passage) pairs from the given pages, best first."""
+        if not urls:
+            return []
+        num_passages, avg_length = self._connection.execute(
+            "SELECT COUNT(*), AVG(length) FROM passages").fetchone()
+        if not num_passages:
+            return []
+        url_placeholders = ",".join("?" * len(urls))
+        scores: Dict[int, float] = Counter()
+        for term in set(_tokenize(query)):
+            (df,) = self._connection.execute(
+                "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()
+            if not df:
+                continue
+            idf = math.log(1 + (num_passages - df + 0.5) / (df + 0.5))
+            rows = self._connection.execute(
+                f"SELECT p.id, t.tf, p.length FROM postings t JOIN passages p ON p.id = t.passage_id"
+                f" WHERE t.term = ? AND p.url IN ({url_placeholders})", (term, *urls))
+            for passage_id, tf, length in rows:
+                norm = self._k1 * (1 - self._b + self._b * length / avg_length)
+                scores[passage_id] += idf * tf * (self._k1 + 1) / (tf + norm)
+        results = []
+        for passage_id, _ in scores.most_common(limit):
+            url, text = self._connection.execute(
+                "SELECT url, text FROM passages WHERE id = ?", (passage_id,)).fetchone()
+            results.append((url, text))
+        return results
+
+
+class PageRetriever:
+    """
+    Fetches search result pages and picks the passages most relevant to a query.
+
+    Pages are fetched concurrently, truncated to max_page_bytes, and cached in
+    the passage index for max_age_days, so pages shared between markets (or
+    runs) are only fetched once. Pages that couldn't be fetched are retried
+    after retry_failed_minutes, so a network blip doesn't drop them for long.
+    """
+
+    def __init__(
+            self,
+            index: PassageIndex,
+            max_workers: int = 8,
+            timeout_seconds: float = 10.0,
+            max_page_bytes: int = 2_000_000,
+            max_age_days: float = 7.0,
+            retry_failed_minutes: float = 60.0,
+            max_passages: int = 5,
+            max_chars: int = 4000,
+    ):
+        self._index = index
+        self._max_workers = max_workers
+        self._timeout_seconds = timeout_seconds
+        self._max_page_bytes = max_page_bytes
+        self._max_age_seconds = max_age_days * 86400
+        self._retry_failed_seconds = retry_failed_minutes * 60
+        self._max_passages = max_passages
+        self._max_chars = max_chars
+        self._index_lock = threading.Lock()
+        # Imported here so that runs without page fetching start quickly.
+        import requests
+        self._requests = requests
+        self._session = requests.Session()
+
+    def _fetch_text(self, url: str) -> Optional[str]:
+        """Returns the text of the page, or None if it can't be fetched."""
+        start_time = time.monotonic()
+        try:
+            with self._session.get(url, timeout=self._timeout_seconds, stream=True) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "")
+                if "html" not in content_type and not content_type.startswith("text/"):
+                    return None
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(chunk_size=65536):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= self._max_page_bytes or time.monotonic() - start_time > self._timeout_seconds:
+                        break
+                content = b"".join(chunks)[:self._max_page_bytes]
+                content = content.decode(self._get_encoding(response), errors="replace")
+        except self._requests.exceptions.RequestException as e:
+            print(f"WARNING: could not fetch {url}: {e}")
+            return None
+        if "html" in content_type:
+            try:
+                return extract_text(content)
+            except Exception as e:
+                # A malformed page shouldn't stop the market from getting a decision.
+                print(f"WARNING: could not parse {url}: {e}")
+                return None
+        return content
+
+    @staticmethod
+    def _get_encoding(response) -> str:
+        # The encoding comes from the page's Content-Type, so it may be anything.
+        encoding = response.encoding or "utf-8"
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            return "utf-8"
+        return encoding
+
+    def _is_cached(self, url: str) -> bool:
+        status = self._index.get_fetch_status(url)
+        if status is None:
+            return False
+        fetched_at, failed = status
+        max_age_seconds = self._retry_failed_seconds if failed else self._max_age_seconds
+        return time.time() - fetched_at < max_age_seconds
+
+    def retrieve(self, query: str, urls: Sequence[str]) -> List[str]:
+        urls = list(dict.fromkeys(urls))
+        with self._index_lock:
+            to_fetch = [url for url in urls if not self._is_cached(url)]
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                texts = list(executor.map(self._fetch_text, to_fetch))
+            # Only the fetching happens in the workers, since the index can
+            # only be used by one thread at a time.
+            with self._index_lock:
+                for url, text in zip(to_fetch, texts):
+                    if text is None:
+                        self._index.add_page(url, [], failed=True)
+                    else:
+                        self._index.add_page(url, split_passages(text))
+
+        with self._index_lock:
+            passages = self._index.search(query, urls, limit=self._max_passages)
+        results = []
+        num_chars = 0
+        for url, passage in passages:
+            if num_chars + len(passage) > self._max_chars:
+                break
+            num_chars += len(passage)
+            results.append(f"{passage} (Source: {url})")
+        return results
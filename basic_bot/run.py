@@ -2,14 +2,22 @@ from bot import Bot
 from bettor import Bettor, HttpBettor
 from llm import Llm, MockLlm, ClaudeLlm
 from decision_maker import DecisionMaker, RandomDecisionMaker, LlmDecisionMaker
-from market_fetcher import MarketFetcher, MockMarketFetcher, HttpMarketFetcher
+from market_fetcher import MarketFetcher, MockMarketFetcher, HttpMarketFetcher, PrefetchedMarketFetcher
 from search_handler import SearchHandler, MockSearchHandler, BingSearchHandler
+from page_retriever import PageRetriever, PassageIndex
+from market_clusters import MarketClusterIndex
+from scheduler import MarketScheduler, read_market_entries, load_cached_probabilities
+from work_queue import WorkQueue, get_shard_path, merge_shards
+from strategies import Strategy, load_strategies
 
 import argparse
 import json
-import re
 import os
-from typing import Union
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import List, Union
 
 SEARCH_TYPES = ["mock", "bing", "none"]
 LLM_ARGS = {
@@ -23,12 +31,14 @@ def parse_args():
         description="Run a basic Manifold bot for the Motley Bot Challenge.")
 
     # Define the flags
-    parser.add_argument('--input_file', type=str, required=True,
+    parser.add_argument('--input_file', type=str, required=False,
                         help='Path to the input file containing the prompt or data to process.')
-    parser.add_argument('--output_file', type=str, required=True,
+    parser.add_argument('--output_file', type=str, required=False,
                         help='Path to the output file where the result will be saved.')
     parser.add_argument('--mock_markets', action='store_true',
                         help='Whether to use mock markets instead of the Manifold API.')
+    parser.add_argument('--market_metadata_file', type=str, required=False,
+                        help='Path to the market metadata file written by select_markets.py. If set, only the comments and current probability are fetched for markets found in the file.')
     parser.add_argument('--search_type', type=str, required=False,
                         help=f'Which type of search to use. Valid search types: {", ".join(SEARCH_TYPES)}')
     parser.add_argument('--bet_type', type=str, required=False,
@@ -45,7 +55,114 @@ def parse_args():
                         help='The model name of the LLM to be used to write search queries.')
     parser.add_argument('--search_model', type=str, default="claude-3-5-haiku-latest",
                         help='The model name of the LLM to be used to write search queries.')
-    return parser.parse_args()
+    parser.add_argument('--fetch_pages', action='store_true',
+                        help='With --search_type=bing, whether to fetch the result pages and add their most relevant passages to the search results.')
+    parser.add_argument('--page_cache_path', type=str, default="cache/passages.sqlite3",
+                        help='With --fetch_pages, the SQLite file where fetched pages and their passage index are cached.')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Whether to get a quick forecast from --search_model first, and only run the full --prediction_model forecast when the bet is unclear.')
+    parser.add_argument('--escalation_margin', type=float, default=0.15,
+                        help='With --cascade, run the full forecast if the quick forecast is within this distance of the market probability.')
+    parser.add_argument('--cluster_markets', action='store_true',
+                        help='Whether to share one search query and its results across near-duplicate markets.')
+    parser.add_argument('--cluster_file', type=str, required=False,
+                        help='With --cluster_markets, where to save cluster assignments and their search results, so a resumed run keeps its clusters. Defaults to the output file with .clusters.jsonl appended.')
+    parser.add_argument('--cluster_threshold', type=float, default=0.5,
+                        help='With --cluster_markets, the estimated Jaccard similarity of title and description above which markets share a cluster.')
+    parser.add_argument('--schedule', action='store_true',
+                        help='Whether to process the highest-priority markets first instead of using the input file order.')
+    parser.add_argument('--max_dollars', type=float, required=False,
+                        help='With --schedule, stop before the estimated API spend exceeds this many dollars.')
+    parser.add_argument('--deadline_minutes', type=float, required=False,
+                        help='With --schedule, stop before the estimated wall-clock time exceeds this many minutes.')
+    parser.add_argument('--probability_cache', nargs='*', default=[],
+                        help='With --schedule, output files from past runs to read cached market probabilities from.')
+    parser.add_argument('--queue_path', type=str, required=False,
+                        help='Path to a SQLite work queue shared between workers. If set, this process claims markets from the queue and writes its decisions to its own shard of --output_file.')
+    parser.add_argument('--worker_id', type=str, default=f"{socket.gethostname()}-{os.getpid()}",
+                        help='With --queue_path, a name for this worker that is unique across all workers.')
+    parser.add_argument('--lease_minutes', type=float, default=10,
+                        help='With --queue_path, how long a worker may hold a market before other workers can reclaim it.')
+    parser.add_argument('--max_attempts', type=int, default=3,
+                        help='With --queue_path, how many times a market may be claimed without being completed before workers give up on it.')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the shards written by --queue_path workers into --output_file (in queue order, if --queue_path is set), then bet if --bet_type is set.')
+    parser.add_argument('--strategies_file', type=str, required=False,
+                        help='Path to a JSON file listing decision strategies (models, prompts, etc.) to compare. Each market is fetched and searched once, then every strategy makes a decision, written to its own output file. See strategies.py for the format.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Instead of processing --input_file, serve decisions for single markets over a local HTTP API. Decisions are appended to --output_file if it is set.')
+    parser.add_argument('--port', type=int, default=8539,
+                        help='With --daemon, the local port to serve on.')
+    parser.add_argument('--daemon_workers', type=int, default=4,
+                        help='With --daemon, how many markets to process concurrently.')
+    args = parser.parse_args()
+    if not args.schedule:
+        # Otherwise the budget would be silently ignored.
+        for flag in ("max_dollars", "deadline_minutes", "probability_cache"):
+            if getattr(args, flag) not in (None, []):
+                parser.error(f"--{flag} requires --schedule")
+    if args.strategies_file:
+        # Strategies are compared on the same markets in one process, with any
+        # cascade configured per strategy.
+        for flag in ("schedule", "max_dollars", "deadline_minutes", "queue_path", "cascade", "daemon", "merge"):
+            if getattr(args, flag) not in (None, False):
+                parser.error(f"--{flag} can't be used with --strategies_file")
+        if args.bet_type and args.bet_type != "none":
+            parser.error("Multi-strategy runs don't bet, so --bet_type must be none or unset. Rerun with a single strategy's output file to bet.")
+    if args.daemon:
+        # The daemon only makes decisions, one market at a time as requested.
+        if args.bet_type and args.bet_type != "none":
+            parser.error("--daemon doesn't bet, so --bet_type must be none or unset")
+        for flag in ("input_file", "queue_path", "merge", "schedule", "max_dollars", "deadline_minutes"):
+            if getattr(args, flag) not in (None, False):
+                parser.error(f"--daemon serves markets as they're requested, so it can't be used with --{flag}")
+    else:
+        if not args.output_file:
+            parser.error("--output_file is required unless --daemon is set")
+        if not args.input_file and not args.merge:
+            parser.error("--input_file is required unless --daemon or --merge is set")
+    return args
+
+
+def record_market_cost(scheduler: MarketScheduler, seconds: float, decision):
+    # With --cascade, only escalated markets pay for the full decision.
+    skipped_stages = ["decision"] if decision.get("escalated") is False else []
+    scheduler.record(seconds, dollars=scheduler.get_dollars_without(skipped_stages))
+
+
+def read_processed_markets(output_file: str):
+    processed_markets = set()
+    if os.path.exists(output_file):
+        with open(output_file, 'r') as outfile:
+            for line in outfile:
+                decision = json.loads(line)
+                if 'market_url' in decision:
+                    processed_markets.add(decision['market_url'])
+    return processed_markets
+
+
+def bet_on_decisions(output_file: str, bot: Bot, bettor: Bettor):
+    bet_markets = set()
+    with open(output_file, 'r') as outfile:
+        market_i = 0
+        for line in outfile:
+            if not line:
+                continue
+            decision = json.loads(line)
+            market_url = decision['market_url']
+
+            if market_url in bet_markets:
+                print(f"Skipping already bet market: {market_url}")
+                continue
+            bet_markets.add(market_url)
+            market_i += 1
+
+            market_data = bot.get_market_data(market_url)
+            market_id = market_data['id']
+            decision_str = decision['decision']
+            print(f"{market_i}. Bet {decision_str} on {market_url}...")
+            bettor.bet(market_id, decision_str)
+            print(f"{market_i}. Bet {decision_str} on {market_url}")
 
 
 def process_markets_file(
@@ -54,6 +171,7 @@ def process_markets_file(
         bot: Bot,
         bettor: Union[Bettor, None],
         market_fetcher: MarketFetcher,
+        scheduler: Union[MarketScheduler, None] = None,
 ):
     # Collect already processed markets if output_file exists.
     # This lets you use data from a past run. There are two reasons you might
@@ -64,29 +182,34 @@ def process_markets_file(
     #   executing them. You can do this by populating output_file completely
     #   with --bet_type=none, then rerunning the script with the same output_file
     #   and --bet_type=real.
-    processed_markets = set()
-    if os.path.exists(output_file):
-        with open(output_file, 'r') as outfile:
-            for line in outfile:
-                decision = json.loads(line)
-                if 'market_url' in decision:
-                    processed_markets.add(decision['market_url'])
+    processed_markets = read_processed_markets(output_file)
 
-    with open(input_file, 'r') as infile, open(output_file, 'a') as outfile:
-        market_i = 0
-        for line in infile:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
+    entries = read_market_entries(input_file)
+    if scheduler:
+        entries = scheduler.order(entries)
 
-            market_i += 1
-            market_url = re.split(r'[ \t]+#', line)[0].strip()
+    with open(output_file, 'a') as outfile:
+        for entry in entries:
+            market_i = entry.index
+            market_url = entry.url
             if market_url in processed_markets:
                 print(f"{market_i}. Skipping already processed market: {market_url}")
                 continue
 
+            if scheduler:
+                stop_reason = scheduler.stop_reason()
+                if stop_reason:
+                    print(f"Stopping early: {stop_reason}")
+                    break
+            start_time = time.monotonic()
+
             decision, market_data = bot.get_decision_for_market(market_url)
             outfile.write(json.dumps(decision) + "\n")
+            # Flush so that an interrupted run keeps every finished market.
+            outfile.flush()
+
+            if scheduler:
+                record_market_cost(scheduler, time.monotonic() - start_time, decision)
 
             print(
                 f"{market_i}. Market: {market_url}, Decision: {decision['decision']}")
@@ -94,29 +217,127 @@ def process_markets_file(
             # Prevents duplication if the same market appears twice (shouldn't happen, but it does).
             processed_markets.add(market_url)
 
-    if not bettor:
-        return
-    bet_markets = set()
-    with open(output_file, 'r') as outfile:
-        market_i = 0
-        for line in outfile:
-            if not line:
+    if bettor:
+        bet_on_decisions(output_file, bot, bettor)
+
+
+def process_markets_queue(
+        input_file: str,
+        output_file: str,
+        queue: WorkQueue,
+        worker_id: str,
+        lease_seconds: float,
+        bot: Bot,
+        scheduler: Union[MarketScheduler, None] = None,
+):
+    # Any worker may enqueue the input file. Markets that are already queued
+    # keep their state, so starting more workers later is safe.
+    entries = read_market_entries(input_file)
+    if scheduler:
+        entries = scheduler.order(entries)
+    queue.add_markets([entry.url for entry in entries],
+                      done_urls=read_processed_markets(output_file))
+
+    shard_file = get_shard_path(output_file, worker_id)
+    with open(shard_file, 'a') as outfile:
+        while True:
+            if scheduler:
+                stop_reason = scheduler.stop_reason()
+                if stop_reason:
+                    print(f"Stopping early: {stop_reason}")
+                    break
+
+            market_url = queue.claim(worker_id, lease_seconds)
+            if market_url is None:
+                break
+            start_time = time.monotonic()
+
+            try:
+                decision, market_data = bot.get_decision_for_market(market_url)
+            except Exception as e:
+                # Keep going, so one bad market doesn't stop every worker.
+                gave_up = queue.fail(market_url, worker_id)
+                print(f"WARNING: [{worker_id}] failed to process {market_url}: {e}"
+                      + (" Giving up on it." if gave_up else " It will be retried."))
                 continue
-            decision = json.loads(line)
-            market_url = decision['market_url']
+            except BaseException:
+                queue.release(market_url, worker_id)
+                raise
+            outfile.write(json.dumps(decision) + "\n")
+            outfile.flush()
+            queue.complete(market_url, worker_id)
 
-            if market_url in bet_markets:
-                print(f"Skipping already bet market: {market_url}")
+            if scheduler:
+                record_market_cost(scheduler, time.monotonic() - start_time, decision)
+
+            print(
+                f"[{worker_id}] Market: {market_url}, Decision: {decision['decision']}")
+
+    failed_urls = queue.get_failed_urls()
+    if failed_urls:
+        print(f"[{worker_id}] {len(failed_urls)} markets failed too many times: {', '.join(failed_urls)}")
+    remaining = queue.count_remaining()
+    if remaining:
+        print(f"[{worker_id}] Done. {remaining} markets are still pending or claimed by other workers.")
+    else:
+        print(f"[{worker_id}] Done. All markets are processed, run with --merge to write {output_file}.")
+
+
+def get_llm(args, llm_type: str, model: str):
+    if llm_type == "mock":
+        return MockLlm()
+    elif llm_type == "claude":
+        with open(args.anthropic_key_path, 'r') as f:
+            anthropic_api_key = f.read().strip()
+        return ClaudeLlm(anthropic_api_key, model=model)
+    else:
+        raise ValueError(f"Unknown LLM: {llm_type}")
+
+
+def get_market_fetcher(args):
+    if args.mock_markets:
+        return MockMarketFetcher()
+    elif args.market_metadata_file:
+        return PrefetchedMarketFetcher(args.market_metadata_file)
+    else:
+        return HttpMarketFetcher()
+
+
+def process_markets_multi_strategy(
+        input_file: str,
+        bot: Bot,
+        strategies: List[Strategy],
+):
+    # Each strategy has its own output file, so each can be resumed separately.
+    processed_markets = {
+        strategy.name: read_processed_markets(strategy.output_file) for strategy in strategies}
+
+    with ExitStack() as stack, ThreadPoolExecutor(max_workers=len(strategies)) as executor:
+        outfiles = {
+            strategy.name: stack.enter_context(open(strategy.output_file, 'a'))
+            for strategy in strategies}
+        for entry in read_market_entries(input_file):
+            market_i = entry.index
+            market_url = entry.url
+            pending = [s for s in strategies if market_url not in processed_markets[s.name]]
+            if not pending:
+                print(f"{market_i}. Skipping already processed market: {market_url}")
                 continue
-            bet_markets.add(market_url)
-            market_i += 1
 
-            market_data = bot.get_market_data(market_url)
-            market_id = market_data['id']
-            decision_str = decision['decision']
-            print(f"{market_i}. Bet {decision_str} on {market_url}...")
-            bettor.bet(market_id, decision_str)
-            print(f"{market_i}. Bet {decision_str} on {market_url}")
+            # Fetch the market and search once, then run every strategy on it.
+            context = bot.get_market_context(market_url)
+            futures = [
+                (strategy, executor.submit(
+                    bot.get_decision_from_context, context, strategy.decision_maker, strategy.prompt_template))
+                for strategy in pending]
+            for strategy, future in futures:
+                decision = future.result()
+                decision["strategy"] = strategy.name
+                outfiles[strategy.name].write(json.dumps(decision) + "\n")
+                outfiles[strategy.name].flush()
+                processed_markets[strategy.name].add(market_url)
+                print(
+                    f"{market_i}. [{strategy.name}] Market: {market_url}, Decision: {decision['decision']}")
 
 
 def get_bettor(args):
@@ -131,6 +352,24 @@ def get_bettor(args):
         raise ValueError(f"Unknown bet type {args.bet_type}")
 
 
+def get_scheduler(args, search_handler):
+    if not args.schedule:
+        return None
+    stages = ["fetch", "decision"]
+    if args.cascade:
+        stages.append("triage")
+    if search_handler:
+        stages += ["search_query", "search"]
+    deadline_seconds = args.deadline_minutes * 60 if args.deadline_minutes is not None else None
+    probabilities = load_cached_probabilities(args.probability_cache)
+    return MarketScheduler(
+        stages,
+        max_dollars=args.max_dollars,
+        deadline_seconds=deadline_seconds,
+        probabilities=probabilities,
+    )
+
+
 def get_search_handler(args):
     if not args.search_type or args.search_type == "none":
         return None
@@ -139,7 +378,10 @@ def get_search_handler(args):
     elif args.search_type == "bing":
         with open(args.bing_key_path, 'r') as f:
             bing_key = f.read().strip()
-        return BingSearchHandler(bing_key)
+        page_retriever = None
+        if args.fetch_pages:
+            page_retriever = PageRetriever(PassageIndex(args.page_cache_path))
+        return BingSearchHandler(bing_key, page_retriever=page_retriever)
     else:
         raise ValueError(f"Unknown search type {args.search_type}")
 
@@ -147,19 +389,11 @@ def get_search_handler(args):
 if __name__ == "__main__":
     args = parse_args()
 
-    market_fetcher = MockMarketFetcher() if args.mock_markets else HttpMarketFetcher()
+    market_fetcher = get_market_fetcher(args)
 
     bettor = get_bettor(args)
 
-    if args.llm == "mock":
-        prediction_llm = MockLlm()
-    elif args.llm == "claude":
-        with open(args.anthropic_key_path, 'r') as f:
-            anthropic_api_key = f.read().strip()
-        prediction_llm = ClaudeLlm(
-            anthropic_api_key, model=args.prediction_model)
-    else:
-        raise ValueError(f"Unknown LLM: {args.llm}")
+    prediction_llm = get_llm(args, args.llm, args.prediction_model)
 
     if args.search_type == "mock":
         search_llm = MockLlm()
@@ -170,11 +404,71 @@ if __name__ == "__main__":
     else:
         search_llm = None
 
-    decision_maker = LlmDecisionMaker(prediction_llm)
+    triage_llm = get_llm(args, args.llm, args.search_model) if args.cascade else None
+
+    decision_maker = LlmDecisionMaker(
+        prediction_llm, triage_llm=triage_llm, escalation_margin=args.escalation_margin)
 
     search_handler = get_search_handler(args)
 
-    bot = Bot(decision_maker, market_fetcher, search_handler, search_llm)
+    market_clusters = None
+    if args.cluster_markets:
+        market_clusters = MarketClusterIndex(threshold=args.cluster_threshold)
+
+    cluster_file = None
+    if market_clusters:
+        cluster_file = args.cluster_file
+        if not cluster_file and args.output_file:
+            # Workers each have their own shard, so they each save their own clusters.
+            base_file = get_shard_path(args.output_file, args.worker_id) if args.queue_path else args.output_file
+            cluster_file = base_file + ".clusters.jsonl"
+
+    bot = Bot(decision_maker, market_fetcher, search_handler, search_llm, market_clusters, cluster_file)
+
+    scheduler = get_scheduler(args, search_handler)
+
+    if args.strategies_file:
+        strategies = load_strategies(
+            args.strategies_file, args.output_file,
+            lambda llm_type, model: get_llm(args, llm_type, model),
+            default_llm=args.llm,
+            default_model=args.prediction_model,
+            default_triage_model=args.search_model,
+            default_escalation_margin=args.escalation_margin,
+        )
+        process_markets_multi_strategy(args.input_file, bot, strategies)
+        for strategy in strategies:
+            if isinstance(strategy.decision_maker, LlmDecisionMaker) and strategy.decision_maker.triage_llm:
+                print(f"[{strategy.name}] {strategy.decision_maker.get_stats_summary()}")
+    elif args.daemon:
+        # Imported here since it's only needed in daemon mode.
+        from daemon import DecisionService, serve
+        serve(DecisionService(bot, args.output_file, max_workers=args.daemon_workers), port=args.port)
+    elif args.merge:
+        queue = WorkQueue(args.queue_path, max_attempts=args.max_attempts) if args.queue_path else None
+        num_decisions = merge_shards(args.output_file, queue)
+        print(f"Merged {num_decisions} decisions into {args.output_file}")
+        if queue:
+            failed_urls = queue.get_failed_urls()
+            if failed_urls:
+                print(f"WARNING: {len(failed_urls)} markets failed too many times and have no decision: {', '.join(failed_urls)}")
+            remaining = queue.count_remaining()
+            if remaining:
+                print(f"WARNING: {remaining} markets are still pending or claimed by workers.")
+        if bettor:
+            bet_on_decisions(args.output_file, bot, bettor)
+    elif args.queue_path:
+        if bettor:
+            print("Workers don't bet. Run with --merge and --bet_type once all workers are done.")
+        process_markets_queue(args.input_file, args.output_file, WorkQueue(args.queue_path, max_attempts=args.max_attempts),
+                              args.worker_id, args.lease_minutes * 60, bot, scheduler)
+    else:
+        process_markets_file(args.input_file, args.output_file,
+                             bot, bettor, market_fetcher, scheduler)
 
-    process_markets_file(args.input_file, args.output_file,
-                         bot, bettor, market_fetcher)
+    if args.cascade:
+        print(decision_maker.get_stats_summary())
+    if market_clusters:
+        clusters = market_clusters.get_clusters()
+        num_markets = sum(len(members) for members in clusters.values())
+        print(f"Grouped {num_markets} markets into {len(clusters)} search clusters.")
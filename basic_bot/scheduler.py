@@ -0,0 +1,189 @@
+import dataclasses
+import datetime
+import json
+import math
+import re
+import time
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+
+@dataclasses.dataclass
+class StageCost:
+    seconds: float
+    dollars: float
+
+    def __add__(self, other):
+        return StageCost(self.seconds + other.seconds, self.dollars + other.dollars)
+
+
+# Rough per-market estimates for each stage of the pipeline. These don't need
+# to be exact, they only have to be good enough to stop before running out of
+# budget. The time estimates get replaced by observed timings once some
+# markets have been processed.
+DEFAULT_STAGE_COSTS = {
+    # Fetching the market and its comments from Manifold.
+    "fetch": StageCost(seconds=1.0, dollars=0.0),
+    # A short Haiku call to write the search query.
+    "search_query": StageCost(seconds=1.0, dollars=0.001),
+    # A single Bing search.
+    "search": StageCost(seconds=1.0, dollars=0.015),
+    # The short Haiku forecast used by --cascade.
+    "triage": StageCost(seconds=2.0, dollars=0.003),
+    # The full Sonnet forecast (~3K tokens in, up to 4096 tokens out).
+    "decision": StageCost(seconds=30.0, dollars=0.05),
+}
+
+
+@dataclasses.dataclass
+class MarketEntry:
+    url: str
+    close_time: Optional[datetime.datetime] = None
+    num_bettors: Optional[int] = None
+    # The position of the market in the input file, starting from 1.
+    index: int = 0
+
+
+# Matches the comment column written by select_markets.py, e.g.
+# "# Closes 2025-01-01 04:59:00. 10 bettors. Tags: ['fun']"
+_CLOSE_TIME_REGEX = re.compile(r'Closes (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+_BETTORS_REGEX = re.compile(r'(\d+) bettors')
+
+
+def parse_market_line(line: str) -> Optional[MarketEntry]:
+    """Parses a line of a markets file, returning None for blank lines and comments."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    parts = re.split(r'[ \t]+#', line, maxsplit=1)
+    entry = MarketEntry(url=parts[0].strip())
+    if len(parts) > 1:
+        comment = parts[1]
+        close_match = _CLOSE_TIME_REGEX.search(comment)
+        if close_match:
+            entry.close_time = datetime.datetime.strptime(
+                close_match.group(1), "%Y-%m-%d %H:%M:%S")
+        bettors_match = _BETTORS_REGEX.search(comment)
+        if bettors_match:
+            entry.num_bettors = int(bettors_match.group(1))
+    return entry
+
+
+def read_market_entries(input_file: str) -> List[MarketEntry]:
+    entries = []
+    with open(input_file, 'r') as infile:
+        for line in infile:
+            entry = parse_market_line(line)
+            if entry is None:
+                continue
+            entry.index = len(entries) + 1
+            entries.append(entry)
+    return entries
+
+
+def load_cached_probabilities(paths: Iterable[str]) -> Dict[str, float]:
+    """Reads market probabilities recorded in the output files of past runs."""
+    probabilities = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                decision = json.loads(line)
+                if decision.get('market_probability') is not None:
+                    probabilities[decision['market_url']] = decision['market_probability']
+    return probabilities
+
+
+class MarketScheduler:
+    """
+    Orders markets so the most valuable ones are forecast first, and stops the
+    run before it exceeds its dollar budget or its wall-clock deadline.
+    """
+
+    def __init__(
+            self,
+            stages: Sequence[str],
+            stage_costs: Dict[str, StageCost] = DEFAULT_STAGE_COSTS,
+            max_dollars: Optional[float] = None,
+            deadline_seconds: Optional[float] = None,
+            probabilities: Optional[Dict[str, float]] = None,
+            now: Optional[datetime.datetime] = None,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self._stages = list(stages)
+        self._stage_costs = stage_costs
+        self._estimate = self.get_stages_cost(self._stages)
+        self._max_dollars = max_dollars
+        self._deadline_seconds = deadline_seconds
+        self._probabilities = probabilities or {}
+        # Close times from select_markets are naive UTC, so compare them with
+        # the current time in UTC rather than local time.
+        self._now = now or datetime.datetime.utcnow()
+        self._clock = clock
+        self._start = clock()
+        self._spent_dollars = 0.0
+        self._observed_seconds = []
+        self._num_recorded = 0
+
+    def get_stages_cost(self, stages: Iterable[str]) -> StageCost:
+        cost = StageCost(0.0, 0.0)
+        for stage in stages:
+            cost += self._stage_costs[stage]
+        return cost
+
+    def get_dollars_without(self, skipped_stages: Iterable[str]) -> float:
+        """The estimated dollars for a market where some stages didn't run (e.g. an unescalated cascade)."""
+        skipped_stages = set(skipped_stages)
+        return self.get_stages_cost(s for s in self._stages if s not in skipped_stages).dollars
+
+    def priority(self, entry: MarketEntry) -> float:
+        # Expected edge is highest when the market is most uncertain. A market
+        # priced at 0.5 has p * (1 - p) = 0.25, a market priced at 0.99 has
+        # ~0.01. If we don't know the probability, assume the best case so
+        # unknown markets aren't starved by ones we've seen before.
+        p = self._probabilities.get(entry.url)
+        edge = 0.25 if p is None else p * (1 - p)
+        # More bettors means a more liquid and more trusted market.
+        bettors = 1 + math.log1p(entry.num_bettors or 0)
+        # Markets that close sooner resolve sooner, so they're worth more.
+        urgency = 1.0
+        if entry.close_time is not None:
+            days_left = max(0.0, (entry.close_time - self._now).total_seconds() / 86400)
+            urgency = 1 / (1 + days_left / 30)
+        return edge * bettors * urgency
+
+    def order(self, entries: Sequence[MarketEntry]) -> List[MarketEntry]:
+        # Python's sort is stable, so ties keep their order from the input file.
+        return sorted(entries, key=self.priority, reverse=True)
+
+    def estimated_market_cost(self) -> StageCost:
+        seconds = self._estimate.seconds
+        dollars = self._estimate.dollars
+        if self._num_recorded:
+            seconds = sum(self._observed_seconds) / self._num_recorded
+            # Markets can cost less than the estimate (e.g. with --cascade),
+            # so use the average so far.
+            dollars = self._spent_dollars / self._num_recorded
+        return StageCost(seconds=seconds, dollars=dollars)
+
+    def elapsed_seconds(self) -> float:
+        return self._clock() - self._start
+
+    def spent_dollars(self) -> float:
+        return self._spent_dollars
+
+    def stop_reason(self) -> Optional[str]:
+        """Returns why the next market can't be processed, or None if it can."""
+        cost = self.estimated_market_cost()
+        if self._max_dollars is not None and self._spent_dollars + cost.dollars > self._max_dollars:
+            return f"budget of ${self._max_dollars:.2f} would be exceeded (spent ${self._spent_dollars:.2f})"
+        if self._deadline_seconds is not None and self.elapsed_seconds() + cost.seconds > self._deadline_seconds:
+            return f"deadline of {self._deadline_seconds:.0f}s would be exceeded (elapsed {self.elapsed_seconds():.0f}s)"
+        return None
+
+    def record(self, seconds: float, dollars: Optional[float] = None):
+        """Records the cost of a processed market. Uses the estimate if dollars is None."""
+        self._observed_seconds.append(seconds)
+        self._num_recorded += 1
+        self._spent_dollars += self._estimate.dollars if dollars is None else dollars
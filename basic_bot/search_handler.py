@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-import requests
+from typing import Optional
+
+from page_retriever import PageRetriever
 
 
 class SearchHandler(ABC):
@@ -16,9 +18,14 @@ class MockSearchHandler(SearchHandler):
 class BingSearchHandler(SearchHandler):
     _SEARCH_URL = "https://api.bing.microsoft.com/v7.0/search"
 
-    def __init__(self, api_key, results_per_query: int = 5):
+    def __init__(self, api_key, results_per_query: int = 5, page_retriever: Optional[PageRetriever] = None):
         self._api_key = api_key
         self._results_per_query = results_per_query
+        # If set, passages from the result pages are added after the snippets.
+        self._page_retriever = page_retriever
+        # Imported here so that runs without Bing search start quickly.
+        import requests
+        self._session = requests.Session()
 
     def _format_snippet(self, snippet):
         result = snippet['snippet']
@@ -32,7 +39,7 @@ class BingSearchHandler(SearchHandler):
         # The query might come in quotes, which will severely restrict search results.
         # Just remove all quotes from the string.
         query = query.replace('"', "").replace("'", "")
-        response = requests.get(
+        response = self._session.get(
             self._SEARCH_URL,
             headers={"Ocp-Apim-Subscription-Key": self._api_key},
             params={"q": query, "count": self._results_per_query}
@@ -42,7 +49,8 @@ class BingSearchHandler(SearchHandler):
 
         if 'webPages' not in search_results:
             return []
-        return [
-            self._format_snippet(snippet)
-            for snippet in search_results['webPages']['value']
-        ]
+        web_pages = search_results['webPages']['value']
+        results = [self._format_snippet(snippet) for snippet in web_pages]
+        if self._page_retriever:
+            results += self._page_retriever.retrieve(query, [page['url'] for page in web_pages])
+        return results
@@ -0,0 +1,91 @@
+import dataclasses
+import json
+import os
+
+from typing import Callable, List, Optional
+
+from decision_maker import DecisionMaker, RandomDecisionMaker, LlmDecisionMaker
+from llm import Llm
+
+
+@dataclasses.dataclass
+class Strategy:
+    """A way of making decisions to compare against others on the same market context."""
+    name: str
+    decision_maker: DecisionMaker
+    output_file: str
+    # A format string to use instead of the default prompt. See
+    # Bot._generate_final_decision_prompt for the available fields.
+    prompt_template: Optional[str] = None
+
+
+def get_strategy_output_file(output_file: str, name: str) -> str:
+    # e.g. output_data/results.jsonl -> output_data/results.sonnet.jsonl
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.{name}{ext}"
+
+
+def load_strategies(
+        config_file: str,
+        output_file: str,
+        get_llm: Callable[[str, str], Llm],
+        default_llm: str,
+        default_model: str,
+        default_triage_model: str,
+        default_escalation_margin: float = 0.15,
+) -> List[Strategy]:
+    """
+    Reads a JSON list of strategies, each of which looks like e.g.
+
+    {
+        "name": "haiku-cascade",       # Required, and must be unique.
+        "decision_maker": "llm",       # "llm" (default) or "random".
+        "llm": "claude",               # Defaults to --llm.
+        "model": "claude-3-5-haiku-latest",  # Defaults to --prediction_model.
+        "cascade": true,               # See --cascade, which can't be used with strategies.
+        "triage_model": "...",         # Defaults to --search_model.
+        "escalation_margin": 0.15,     # Defaults to --escalation_margin.
+        "prompt_file": "prompts/short.txt",  # Defaults to the standard prompt.
+        "output_file": "..."           # Defaults to output_file with the name added.
+    }
+
+    get_llm takes an LLM type (e.g. "claude") and a model name.
+    """
+    with open(config_file, 'r') as f:
+        configs = json.load(f)
+
+    strategies = []
+    for config in configs:
+        name = config["name"]
+        decision_maker_type = config.get("decision_maker", "llm")
+        if decision_maker_type == "random":
+            decision_maker = RandomDecisionMaker()
+        elif decision_maker_type == "llm":
+            llm_type = config.get("llm", default_llm)
+            triage_llm = None
+            if config.get("cascade"):
+                triage_llm = get_llm(llm_type, config.get("triage_model", default_triage_model))
+            decision_maker = LlmDecisionMaker(
+                get_llm(llm_type, config.get("model", default_model)),
+                triage_llm=triage_llm,
+                escalation_margin=config.get("escalation_margin", default_escalation_margin),
+            )
+        else:
+            raise ValueError(f"Unknown decision maker {decision_maker_type} in strategy {name}")
+
+        prompt_template = None
+        if "prompt_file" in config:
+            with open(config["prompt_file"], 'r') as f:
+                prompt_template = f.read()
+
+        strategies.append(Strategy(
+            name=name,
+            decision_maker=decision_maker,
+            output_file=config.get("output_file", get_strategy_output_file(output_file, name)),
+            prompt_template=prompt_template,
+        ))
+
+    names = [strategy.name for strategy in strategies]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Strategy names must be unique, got: {names}")
+    return strategies
@@ -0,0 +1,157 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+
+from typing import Callable, List, Optional, Sequence
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+# The market failed max_attempts times, so no worker will claim it again.
+FAILED = "failed"
+
+
+class WorkQueue:
+    """
+    A queue of market URLs shared between worker processes through a SQLite file.
+
+    A worker claims a market by taking a lease on it. If the worker dies before
+    completing the market, the lease expires and another worker reclaims it.
+    A market is given up on once it has been claimed max_attempts times
+    without being completed, so one bad market can't crash every worker.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3, clock: Callable[[], float] = time.time):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Leave autocommit on and manage transactions ourselves, so claims can
+        # take the write lock before reading.
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._clock = clock
+        self._max_attempts = max_attempts
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS markets (
+                url TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def add_markets(self, urls: Sequence[str], done_urls: Sequence[str] = ()):
+        """Adds markets in priority order. Markets that are already queued are left alone."""
+        done_urls = set(done_urls)
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            (start,) = self._connection.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM markets").fetchone()
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO markets (url, position, status) VALUES (?, ?, ?)",
+                [(url, start + i, DONE if url in done_urls else PENDING) for i, url in enumerate(urls)])
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def claim(self, worker: str, lease_seconds: float) -> Optional[str]:
+        """Claims the next pending or expired market, or returns None if there is none."""
+        now = self._clock()
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Give up on expired markets that have used all their attempts.
+            self._connection.execute(
+                "UPDATE markets SET status = ?, lease_expires = NULL"
+                " WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, CLAIMED, now, self._max_attempts))
+            row = self._connection.execute(
+                "SELECT url FROM markets"
+                " WHERE status = ? OR (status = ? AND lease_expires < ?)"
+                " ORDER BY position LIMIT 1",
+                (PENDING, CLAIMED, now)).fetchone()
+            if row:
+                self._connection.execute(
+                    "UPDATE markets SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1"
+                    " WHERE url = ?",
+                    (CLAIMED, worker, now + lease_seconds, row[0]))
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def complete(self, url: str, worker: str):
+        self._connection.execute(
+            "UPDATE markets SET status = ?, lease_expires = NULL WHERE url = ? AND worker = ?",
+            (DONE, url, worker))
+
+    def release(self, url: str, worker: str):
+        """Gives up a claimed market so another worker can take it right away."""
+        self._connection.execute(
+            "UPDATE markets SET status = ?, worker = NULL, lease_expires = NULL"
+            " WHERE url = ? AND worker = ? AND status = ?",
+            (PENDING, url, worker, CLAIMED))
+
+    def fail(self, url: str, worker: str) -> bool:
+        """
+        Records that processing a claimed market failed. It becomes pending
+        again unless it has used all its attempts. Returns True if it was given up on.
+        """
+        self._connection.execute(
+            "UPDATE markets SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+            " worker = NULL, lease_expires = NULL"
+            " WHERE url = ? AND worker = ? AND status = ?",
+            (self._max_attempts, FAILED, PENDING, url, worker, CLAIMED))
+        (status,) = self._connection.execute(
+            "SELECT status FROM markets WHERE url = ?", (url,)).fetchone()
+        return status == FAILED
+
+    def get_ordered_urls(self) -> List[str]:
+        return [row[0] for row in self._connection.execute("SELECT url FROM markets ORDER BY position")]
+
+    def count_remaining(self) -> int:
+        """Counts the markets that are pending or claimed."""
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM markets WHERE status IN (?, ?)", (PENDING, CLAIMED)).fetchone()
+        return count
+
+    def get_failed_urls(self) -> List[str]:
+        return [row[0] for row in self._connection.execute(
+            "SELECT url FROM markets WHERE status = ? ORDER BY position", (FAILED,))]
+
+
+def get_shard_path(output_file: str, worker: str) -> str:
+    return f"{output_file}.shard-{worker}"
+
+
+def merge_shards(output_file: str, queue: Optional[WorkQueue] = None) -> int:
+    """
+    Merges the decisions in output_file and all of its shards back into
+    output_file, in queue order if a queue is given. If a market was decided
+    more than once (e.g. because a lease expired mid-forecast), the first
+    decision found is kept. Returns the number of decisions written.
+    """
+    decisions = {}
+    paths = ([output_file] if os.path.exists(output_file) else []) + sorted(
+        glob.glob(glob.escape(output_file) + ".shard-*"))
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                decision = json.loads(line)
+                decisions.setdefault(decision['market_url'], decision)
+
+    order = {url: i for i, url in enumerate(queue.get_ordered_urls())} if queue else {}
+    urls = sorted(decisions, key=lambda url: order.get(url, len(order)))
+
+    # Write to a temporary file first so output_file is never left half-written.
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        for url in urls:
+            f.write(json.dumps(decisions[url]) + "\n")
+    os.replace(tmp_file, output_file)
+    return len(urls)
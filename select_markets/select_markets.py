@@ -1,6 +1,10 @@
 import argparse
 import dataclasses
+import json
+import math
+import numpy as np
 import pytz
+import os
 import random
 import requests
 import time
@@ -8,7 +12,7 @@ import time
 # from collections.abc import Collection
 from datetime import datetime, timedelta
 from tqdm import tqdm
-from typing import Tuple, Sequence, Collection, Optional
+from typing import Dict, List, Tuple, Sequence, Collection, Optional
 
 PAGE_LENGTH = 1000
 
@@ -89,13 +93,21 @@ class Market:
     url: str
     close_time: datetime
     num_bettors: int
+    # The close time as a UTC timestamp in milliseconds, as returned by the API.
+    close_millis: int
     _tags: Optional[Collection[str]] = None
+    # The fields in METADATA_FIELDS that we know, to be written to the metadata file.
+    metadata: Dict = dataclasses.field(default_factory=dict)
 
     @property
     def tags(self):
         """Lazily calculate tags."""
         if self._tags is None:
-            self._tags = get_market_tags(self.market_id)
+            market_json = get_full_market_json(self.market_id)
+            self._tags = get_market_tags(market_json)
+            # Search results don't include the description, but the full market does.
+            if "textDescription" in market_json:
+                self.metadata["textDescription"] = market_json["textDescription"]
         return self._tags
 
     def has_tags(self):
@@ -106,31 +118,173 @@ class Market:
         # market_id should be sufficient to identify the Market.
         return hash(self.market_id)
 
-def get_market_from_json(market_json):
+# The fields written to the metadata file, so that basic_bot doesn't need to
+# fetch each market again. The names match the Manifold API.
+METADATA_FIELDS = ("id", "question", "textDescription", "probability", "closeTime", "creatorName", "fetchedTime")
+
+def get_market_from_json(market_json, tags: Optional[Collection[str]] = None, description: Optional[str] = None):
     market = Market(
             market_id=market_json["id"],
             url=market_json["url"],
             close_time=get_datetime(market_json["closeTime"]),
             num_bettors=market_json["uniqueBettorCount"],
+            close_millis=market_json["closeTime"],
+            _tags=tags,
+            metadata={field: market_json[field] for field in METADATA_FIELDS if field in market_json},
             )
+    if description is not None:
+        market.metadata["textDescription"] = description
     return market
 
-def get_markets_in_time_range(min_close_time: datetime, max_close_time: datetime):
-    offset = get_start_offset_for_time(min_close_time)
-    markets = []
-    done = False
+# The fields of each market's JSON that are saved in checkpoints.
+CHECKPOINT_MARKET_FIELDS = ("url", "uniqueBettorCount") + METADATA_FIELDS
+
+@dataclasses.dataclass
+class Checkpoint:
+    """
+    The progress of a run, saved to disk so an interrupted run can be resumed with --resume.
+
+    The scanned markets and fetched tags are appended to JSONL files next to
+    the checkpoint (see markets_path and tags_path), so saving doesn't rewrite
+    them all. The checkpoint itself only records how much of each file is valid.
+    """
+    path: str
+    # Identifies the run, so we don't resume a checkpoint from a different one.
+    config: Dict
+    seed: int
+    # The offset of the next page to fetch, or None if the start offset isn't known yet.
+    next_offset: Optional[int] = None
+    scan_done: bool = False
+    # The size in bytes of the markets file as of next_offset. Anything past
+    # it is from a page that was interrupted before the checkpoint was saved.
+    markets_file_size: int = 0
+    # The size in bytes of the tags file as of the last save.
+    tags_file_size: int = 0
+    # Tags of each market ID, for markets whose tags have been fetched.
+    tags: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+    # Descriptions of each market ID, from the same requests as the tags.
+    descriptions: Dict[str, str] = dataclasses.field(default_factory=dict)
+    # Tag records that haven't been appended to the tags file yet.
+    _unsaved_tags: List[Dict] = dataclasses.field(default_factory=list, repr=False)
+
+    # Fields that are kept in memory or in the JSONL files, not in the checkpoint itself.
+    _UNSAVED_FIELDS = ("path", "tags", "descriptions", "_unsaved_tags")
+
+    @property
+    def markets_path(self) -> str:
+        return self.path + ".markets.jsonl"
+
+    @property
+    def tags_path(self) -> str:
+        return self.path + ".tags.jsonl"
+
+    def add_tags(self, market_id: str, tags: Collection[str], description: Optional[str]):
+        """Records the tags (and description) of a market, to be saved with the next save()."""
+        self.tags[market_id] = list(tags)
+        record = {"id": market_id, "tags": self.tags[market_id]}
+        if description is not None:
+            self.descriptions[market_id] = description
+            record["description"] = description
+        self._unsaved_tags.append(record)
+
+    def save(self):
+        if self._unsaved_tags:
+            with open(self.tags_path, 'a') as f:
+                for record in self._unsaved_tags:
+                    f.write(json.dumps(record) + "\n")
+                self.tags_file_size = f.tell()
+            self._unsaved_tags = []
+        data = {field.name: getattr(self, field.name) for field in dataclasses.fields(self)
+                if field.name not in self._UNSAVED_FIELDS}
+        # Write to a temporary file first, so an interruption can't leave a corrupt checkpoint.
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def add_page(self, market_jsons: Sequence[Dict], next_offset: int, scan_done: bool):
+        """Saves a scanned page of markets along with the offset of the next page."""
+        with open(self.markets_path, 'a') as f:
+            for market_json in market_jsons:
+                f.write(json.dumps(market_json) + "\n")
+            self.markets_file_size = f.tell()
+        self.next_offset = next_offset
+        self.scan_done = scan_done
+        self.save()
+
+    def _read_jsonl(self, path: str, size: int) -> List[Dict]:
+        """Returns the records in the first size bytes of path, dropping any written after the last save."""
+        if not os.path.exists(path):
+            if size:
+                raise ValueError(f"Can't resume from {self.path}, since {path} is missing")
+            return []
+        # Truncate rather than just skipping the extra lines, so records
+        # appended after resuming follow on directly from the saved ones.
+        os.truncate(path, size)
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def load_market_jsons(self) -> List[Dict]:
+        """Returns the markets of the saved pages, dropping any from an interrupted page."""
+        return self._read_jsonl(self.markets_path, self.markets_file_size)
+
+    def clear_files(self):
+        """Empties the JSONL files, e.g. left over from an earlier run that isn't being resumed."""
+        for path in (self.markets_path, self.tags_path):
+            open(path, 'w').close()
+
+    def remove(self):
+        for path in (self.path, self.markets_path, self.tags_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        with open(path, 'r') as f:
+            checkpoint = cls(path=path, **json.load(f))
+        for record in checkpoint._read_jsonl(checkpoint.tags_path, checkpoint.tags_file_size):
+            checkpoint.tags[record["id"]] = record["tags"]
+            if "description" in record:
+                checkpoint.descriptions[record["id"]] = record["description"]
+        return checkpoint
+
+def get_markets_in_time_range(min_close_time: datetime, max_close_time: datetime, checkpoint: Optional[Checkpoint] = None):
+    if checkpoint and checkpoint.next_offset is not None:
+        offset = checkpoint.next_offset
+        market_jsons = checkpoint.load_market_jsons()
+        done = checkpoint.scan_done
+        print(f"Resuming scan from offset {offset} with {len(market_jsons)} markets.")
+    else:
+        offset = get_start_offset_for_time(min_close_time)
+        market_jsons = []
+        done = False
     while not done:
-        for market_json in get_fetch_markets_response(FetchRequest(offset=offset, limit=PAGE_LENGTH)):
+        page = get_fetch_markets_response(FetchRequest(offset=offset, limit=PAGE_LENGTH))
+        fetched_time = int(time.time() * 1000)
+        if not page:
+            # We've run out of markets.
+            done = True
+        page_market_jsons = []
+        for market_json in page:
             close_time = market_json["closeTime"]
             if close_time > get_timestamp(max_close_time):
                 done = True
                 break
             elif close_time < get_timestamp(min_close_time):
-                if markets:
-                    raise ValueError("A market before min close time appeared after the first market had already been added:\n" + str(market))
+                if market_jsons or page_market_jsons:
+                    raise ValueError("A market before min close time appeared after the first market had already been added:\n" + str(market_json))
             else:
-                markets.append(get_market_from_json(market_json))
+                market_json = dict(market_json, fetchedTime=fetched_time)
+                page_market_jsons.append({field: market_json[field] for field in CHECKPOINT_MARKET_FIELDS if field in market_json})
+        market_jsons.extend(page_market_jsons)
         offset += PAGE_LENGTH
+        if checkpoint:
+            # Only save whole pages, so resuming never skips or repeats a market.
+            checkpoint.add_page(page_market_jsons, offset, done)
+    tags = checkpoint.tags if checkpoint else {}
+    descriptions = checkpoint.descriptions if checkpoint else {}
+    markets = [get_market_from_json(market_json, tags.get(market_json["id"]), descriptions.get(market_json["id"]))
+               for market_json in market_jsons]
     # Deduplicate markets and return.
     return list({market.market_id: market for market in markets}.values())
 
@@ -143,38 +297,97 @@ class FilterConfig:
     def __hash__(self):
         return hash((self.last_free_day, tuple(self.bettor_range), tuple(self.bad_tags)))
 
-def days_since(dt, since_datestring: str) -> int:
-    since_datetime = str_to_datetime(since_datestring)
-    return (dt - since_datetime).days
-
-def get_market_tags(market_id: str) -> Collection[str]:
+def get_full_market_json(market_id: str):
     url = "https://api.manifold.markets/v0/market/" + market_id
-    market_json = attempt_get_json(url)
+    return attempt_get_json(url)
+
+def get_market_tags(market_json) -> Collection[str]:
     return set(market_json["groupSlugs"]) if "groupSlugs" in market_json else {}
 
-# Returns a tuple with elements representing filter criteria in order of their priority.
-# This may take a while because market.tags makes a call to the API.
-def get_market_sort_key(market: Market, filter_cfg: FilterConfig):
+EPOCH = datetime(1970, 1, 1)
+MILLIS_PER_DAY = 24 * 60 * 60 * 1000
+
+def get_millis(dt) -> int:
+    # Treats naive datetimes as UTC, like get_datetime.
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+@dataclasses.dataclass
+class MarketColumns:
+    """The fields of a list of markets that matter for sorting, as NumPy arrays."""
+    close_millis: np.ndarray
+    num_bettors: np.ndarray
+    # Bit i is set if the market has bad_tags[i].
+    tag_mask: np.ndarray
+
+# How many tags to fetch between saves of the checkpoint.
+TAG_CHECKPOINT_INTERVAL = 100
+
+def get_market_columns(markets: Sequence[Market], bad_tags: Sequence[str], checkpoint: Optional[Checkpoint] = None) -> MarketColumns:
+    # The bitmask has to fit in an int64.
+    assert len(bad_tags) < 63
+    tag_mask = np.zeros(len(markets), dtype=np.int64)
+    # Tags are fetched from the API, which may take a while, so only do it if there are bad tags.
+    if bad_tags:
+        tag_bits = {tag: 1 << i for i, tag in enumerate(bad_tags)}
+        num_fetched = 0
+        try:
+            for i, market in enumerate(tqdm(markets, desc="Getting market tags")):
+                if checkpoint and not market.has_tags():
+                    checkpoint.add_tags(market.market_id, market.tags, market.metadata.get("textDescription"))
+                    num_fetched += 1
+                    if num_fetched % TAG_CHECKPOINT_INTERVAL == 0:
+                        checkpoint.save()
+                tag_mask[i] = sum(bit for tag, bit in tag_bits.items() if tag in market.tags)
+        finally:
+            if checkpoint and num_fetched:
+                checkpoint.save()
+    return MarketColumns(
+            close_millis=np.fromiter((m.close_millis for m in markets), dtype=np.int64, count=len(markets)),
+            num_bettors=np.fromiter((m.num_bettors for m in markets), dtype=np.int64, count=len(markets)),
+            tag_mask=tag_mask,
+            )
 
-    key = []
+# Returns arrays of penalties representing filter criteria, in order of their priority.
+def get_sort_key_columns(columns: MarketColumns, filter_cfg: FilterConfig) -> Sequence[np.ndarray]:
     # Add a penalty for each bad tag, in order of how important they are to avoid.
-    # Since market.tags is lazily evaluated, the tags won't be fetched if
-    # the list of bad tags is empty.
-    for tag in reversed(filter_cfg.bad_tags):
-        key.append(int(tag in market.tags))
+    # Since the last bad tag has the highest bit, comparing the masks as
+    # integers is the same as comparing the tag penalties in reverse order.
+    keys = [columns.tag_mask]
     # Add a penalty for being below the bettor range, then for being above the bettor range.
-    key.append(max(0, filter_cfg.bettor_range[0] - market.num_bettors))
-    key.append(max(0, market.num_bettors - filter_cfg.bettor_range[1]))
-    # Add a penalty for the close time being past the "last free day."
-    key.append(max(0, days_since(market.close_time, filter_cfg.last_free_day)))
-    # Convert to a tuple so we can use it as a key.
-    return tuple(key)
-
-def filter_markets(markets, max_markets: int, filter_cfg: FilterConfig):
+    keys.append(np.maximum(0, filter_cfg.bettor_range[0] - columns.num_bettors))
+    keys.append(np.maximum(0, columns.num_bettors - filter_cfg.bettor_range[1]))
+    # Add a penalty for each full day the close time is past the "last free day."
+    last_free_millis = get_millis(str_to_datetime(filter_cfg.last_free_day))
+    keys.append(np.maximum(0, (columns.close_millis - last_free_millis) // MILLIS_PER_DAY))
+    return keys
+
+def select_indices(keys: Sequence[np.ndarray], max_markets: int) -> np.ndarray:
+    """
+    Returns the indices of the first max_markets rows when sorted by keys
+    lexicographically, breaking ties by index (like a stable sort).
+    """
+    n = len(keys[0])
+    max_markets = min(max_markets, n)
+    # Pack the keys (and the index, as a tiebreaker) into a single integer if
+    # they fit, so we can use argpartition to avoid sorting all n rows.
+    radixes = [int(k.max()) + 1 if n else 1 for k in keys] + [n]
+    if n and all(k.min() >= 0 for k in keys) and math.prod(radixes) < 2**63:
+        packed = np.zeros(n, dtype=np.int64)
+        for k, radix in zip(keys + [np.arange(n, dtype=np.int64)], radixes):
+            packed = packed * radix + k
+        if max_markets < n:
+            candidates = np.argpartition(packed, max_markets - 1)[:max_markets]
+        else:
+            candidates = np.arange(n)
+        return candidates[np.argsort(packed[candidates])]
+    # np.lexsort is stable and treats the last key as the primary one.
+    return np.lexsort(list(reversed(keys)))[:max_markets]
+
+def filter_markets(markets, max_markets: int, filter_cfg: FilterConfig, checkpoint: Optional[Checkpoint] = None):
     random.shuffle(markets)
-    markets_with_sort_keys = [(get_market_sort_key(m, filter_cfg), m) for m in tqdm(markets, desc="Sorting markets")]
-    markets_with_sort_keys.sort(key=lambda m: m[0])
-    return [m for _, m in markets_with_sort_keys][:max_markets]
+    columns = get_market_columns(markets, filter_cfg.bad_tags, checkpoint)
+    indices = select_indices(get_sort_key_columns(columns, filter_cfg), max_markets)
+    return [markets[i] for i in indices]
 
 def get_market_comment(market: Market, bad_tags: Collection[str]) -> str:
     tags_str = ""
@@ -195,12 +408,48 @@ def write_markets_to_file(markets: Sequence[Market], outfile: str, min_time: dat
             market_str = market.url + "\t\t# " + get_market_comment(market, bad_tags)
             f.write(market_str + '\n')
 
-def main(max_markets: int, last_free_day: str, bettor_range: Tuple[int, int], bad_tags: Sequence[str], outfile: str):
+def get_checkpoint(checkpoint_file: str, resume: bool, config: Dict, seed: Optional[int]) -> Checkpoint:
+    if resume and os.path.exists(checkpoint_file):
+        checkpoint = Checkpoint.load(checkpoint_file)
+        if checkpoint.config != config:
+            raise ValueError(f"Can't resume from {checkpoint_file}, since it was saved with a different configuration:\n{checkpoint.config}")
+        if seed is not None and seed != checkpoint.seed:
+            raise ValueError(f"Can't resume from {checkpoint_file} with --seed {seed}, since it was saved with seed {checkpoint.seed}")
+        print(f"Resuming from {checkpoint_file}.")
+        return checkpoint
+    if seed is None:
+        seed = random.randrange(2**32)
+    checkpoint = Checkpoint(path=checkpoint_file, config=config, seed=seed)
+    checkpoint.clear_files()
+    checkpoint.save()
+    return checkpoint
+
+def write_metadata_to_file(markets: Sequence[Market], metadata_outfile: str):
+    """Writes the metadata of each market to a JSON object keyed by URL, for use by basic_bot."""
+    with open(metadata_outfile, 'w') as f:
+        json.dump({market.url: market.metadata for market in markets}, f, indent=1)
+    num_without_description = sum("textDescription" not in market.metadata for market in markets)
+    if num_without_description:
+        print(f"WARNING: {num_without_description}/{len(markets)} markets in {metadata_outfile} have no description,"
+              " since their tags weren't fetched. basic_bot will fetch these markets in full.")
+
+def main(max_markets: int, last_free_day: str, bettor_range: Tuple[int, int], bad_tags: Sequence[str], outfile: str,
+         seed: Optional[int] = None, checkpoint_file: Optional[str] = None, resume: bool = False,
+         metadata_outfile: Optional[str] = None):
     # If last_free_day is January 1, we should fetch markets with close dates
     # in the range from December 31 to January 7 (including markets that close on January 7).
     min_close_time, max_close_time = get_time_range(last_free_day, days_before=1, days_after=6)
+
+    checkpoint = None
+    if checkpoint_file:
+        config = {"last_free_day": last_free_day, "bettor_range": list(bettor_range), "bad_tags": list(bad_tags), "max_markets": max_markets}
+        checkpoint = get_checkpoint(checkpoint_file, resume, config, seed)
+        seed = checkpoint.seed
+    if seed is not None:
+        random.seed(seed)
+
     print(f"Fetching markets that close between {min_close_time} and {max_close_time}.")
-    markets = get_markets_in_time_range(min_close_time, max_close_time)
+    markets = get_markets_in_time_range(min_close_time, max_close_time, checkpoint)
     print(f"Fetched {len(markets)} markets.")
 
     filter_cfg = FilterConfig(
@@ -208,11 +457,17 @@ def main(max_markets: int, last_free_day: str, bettor_range: Tuple[int, int], ba
             bettor_range = bettor_range,
             bad_tags = bad_tags
             )
-    markets = filter_markets(markets, max_markets=max_markets, filter_cfg=filter_cfg)
+    markets = filter_markets(markets, max_markets=max_markets, filter_cfg=filter_cfg, checkpoint=checkpoint)
     print(f"Filtered to {len(markets)} markets (of {max_markets} maximum).")
 
     write_markets_to_file(markets, outfile, min_close_time, last_free_day, max_close_time, filter_cfg.bad_tags)
     print(f"Wrote markets to {outfile}")
+    if metadata_outfile:
+        write_metadata_to_file(markets, metadata_outfile)
+        print(f"Wrote market metadata to {metadata_outfile}")
+    if checkpoint:
+        # The run is complete, so there's nothing left to resume.
+        checkpoint.remove()
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Selects markets for the Motley Bot Challenge.')
@@ -230,14 +485,22 @@ def parse_args():
         "nonpredictive",
         "unsubsidized"
         ], help='List of bad tags')
-    parser.add_argument('--ignore_tags', action='store_true', help="If true, ignore the tags in bad_tags. This allows the script to run much faster since we don't have to fetch the tags for each individual market.")
+    parser.add_argument('--ignore_tags', action='store_true', help="If true, ignore the tags in bad_tags. This allows the script to run much faster since we don't have to fetch the tags for each individual market, but the metadata file then has no descriptions, since they come from the same requests.")
     parser.add_argument('--outfile', type=str, required=True, help="The file to write a list of markets to.")
+    parser.add_argument('--seed', type=int, required=False, help="A seed for the random shuffle, to make the selection reproducible.")
+    parser.add_argument('--checkpoint_file', type=str, required=False, help="Where to save the progress of the run. Defaults to the outfile with .checkpoint.json appended.")
+    parser.add_argument('--metadata_outfile', type=str, required=False, help="Where to write the metadata of the selected markets (question, description, probability, etc.), so basic_bot can skip fetching them. Defaults to the outfile with .metadata.json appended.")
+    parser.add_argument('--resume', action='store_true', help="If true, resume from the checkpoint file of an interrupted run with the same arguments. The output will be the same as if the run had never stopped.")
 
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
     bad_tags = [] if args.ignore_tags else args.bad_tags
+    checkpoint_file = args.checkpoint_file or args.outfile + ".checkpoint.json"
+    metadata_outfile = args.metadata_outfile or args.outfile + ".metadata.json"
 
-    main(args.max_markets, args.last_free_day, args.bettor_range, bad_tags, args.outfile)
+    main(args.max_markets, args.last_free_day, args.bettor_range, bad_tags, args.outfile,
+         seed=args.seed, checkpoint_file=checkpoint_file, resume=args.resume,
+         metadata_outfile=metadata_outfile)
 